@@ -10,10 +10,12 @@ Description:
 import os
 import subprocess
 import shutil
-import glob
-import filecmp
+import tarfile
+import copy
 import sys
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import gra2pes_config, gra2pes_utils
 sys.path.append(os.path.join(os.path.dirname(__file__),'../..'))
 from utils import gen_utils
@@ -27,18 +29,16 @@ class Gra2pesDownload():
     Attributes:
     config (gra2pes_config.Gra2pesConfig) : configuration object for GRA2PES
     base_path (str) : base path where the data will be stored (part of the config)
-    download_path (str) : path where the data will be downloaded (a temp folder called .download)
     base_download_url (str) : base url where the data lives online
     tar_filename_template (str) : template for the tar file name as stored in base_download_url
     """
 
     tar_filename_template = 'GRA2PESv1.0_{sector}_{yearmonth}.tar.gz' #template for the tar file name as stored in base_download_url
+    _space_lock = threading.Lock() #lock so concurrent download_extract calls don't interleave the space check
 
     def __init__(self, config, data_source = 'https',credentials_path = None, min_space = '1Tb'):
         self.config = config #configuration object for GRA2PES
         self.base_path = config.base_path #base path where the data will be stored
-        self.download_path = os.path.join(self.base_path, '.download') #path where the data will be downloaded (a temp folder called .download)
-        os.makedirs(self.download_path, exist_ok=True) #create the download path if it doesn't exist
         self.data_source = data_source
         self.min_space = min_space
         if data_source == 'https':
@@ -51,27 +51,71 @@ class Gra2pesDownload():
         else:
             raise ValueError(f"Data source {data_source} not recognized")
 
-    def download_extract(self,sector,year,month):
+    def download_extract(self,sector,year,month,overwrite=False):
         '''Main function to download GRA2PES data for a specific sector, year, and month and format the directories nicely
         
         Args:
         sector (str) : sector to download, from the self.config.sectors list
         year (int) : integer year to download
         month (int) : integer month to download
+        overwrite (bool) : whether to download again if the files already exist in the base path, defaults False so re-runs skip finished tars
         '''
-        if sector not in self.config.sectors:
+        if sector not in self.config.sector_set:
             raise ValueError(f"sector {sector} not found in config")
-        if year not in self.config.years:
+        if year not in self.config.year_set:
             raise ValueError(f"year {year} not found in config")
-        if month not in self.config.months:
+        if month not in self.config.month_set:
             raise ValueError(f"month {month} not found in config")
-        gen_utils.check_space(self.base_path,excep_thresh=self.min_space) #check if there is enough space in the base path
+        if not overwrite and self.already_extracted(sector, year, month):
+            print(f"Skipping {sector} for {year}-{month}, already extracted")
+            return
+        with self._space_lock:
+            gen_utils.check_space(self.base_path,excep_thresh=self.min_space) #check if there is enough space in the base path
         
-        tar_fname = self.get_tar_filename(sector, year, month)
         tar_full_url = self.get_tar_url(sector, year, month)
-        self.download_tar(tar_full_url)
-        self.extract_tar(tar_fname,extract_path=self.base_path)
-        self.delete_tar(tar_fname)
+        self.stream_extract_tar(tar_full_url,extract_path=self.base_path)
+
+    def download_extract_many(self, tasks, max_workers=8, overwrite=False):
+        '''Download and extract many (sector, year, month) tars concurrently
+
+        The work is network/disk bound (wget runs in its own process and file writes/zlib release the GIL), so a bounded thread pool is enough.
+
+        Args:
+        tasks (iterable) : (sector, year, month) tuples to download
+        max_workers (int) : number of tars to download and extract at once, defaults 8
+        overwrite (bool) : passed to download_extract
+        '''
+
+        def _download_extract(task):
+            sector, year, month = task
+            print(f'\nDownloading and extracting {sector} for {year}-{month}')
+            self.download_extract(sector,year,month,overwrite=overwrite)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_download_extract, tasks)) #list() so any errors in the threads are raised here
+
+    def already_extracted(self, sector, year, month):
+        """Check whether all of the half-day files for a specific sector, year, and month already exist in the base path
+
+        Extraction writes each file to a '.part' name and renames it when complete (see safe_extract_member), so a file under
+        its real name is never a truncated leftover from a killed download.
+
+        Args:
+        sector (str) : sector to check, from the self.config.sectors list
+        year (int) : integer year to check
+        month (int) : integer month to check
+
+        Returns:
+        bool : True if every day type and half-day file is present
+        """
+
+        handler = gra2pes_utils.BaseGra2pesHandler(self.config) #use the handler's file naming so the check matches what gets loaded
+        for day_type in self.config.day_types:
+            for hour_start in ('00','12'): #each tar holds two half-day files per day type
+                relpath_fname = handler.get_relpath_fname(sector, year, month, day_type, hour_start)
+                if not os.path.isfile(os.path.join(self.base_path,relpath_fname)):
+                    return False
+        return True
 
     def get_tar_filename(self, sector, year, month):
         """Get the tar filename on the server for a specific sector, year, and month
@@ -101,48 +145,26 @@ class Gra2pesDownload():
         """
 
         filename = self.get_tar_filename(sector, year, month)
-        return os.path.join(self.base_download_url,filename)
+        return f"{self.base_download_url.rstrip('/')}/{filename}" #urls always use forward slashes, so don't use os.path.join
     
-    def download_tar(self, tar_full_url):
-        """Download the tar file from the full url to the download path
-        
-        Args:
-        tar_full_url (str) : full url to download the tar file
-        """
+    def stream_extract_tar(self, tar_full_url, extract_path):
+        """Download the tar file from the full url and extract it on the fly to the extract path
 
-        print(f"Downloading {tar_full_url} to {self.download_path}")
-        if self.data_source == 'https':
-            command = ['wget',tar_full_url,'-P',self.download_path] #create the wget command 
-        elif self.data_source == 'ftp':
-            command = ['wget',f'--ftp-user={self.credentials["username"]}',f'--ftp-password={self.credentials["password"]}',
-                       tar_full_url,'-P',self.download_path] #create the wget command
+        wget writes the tar to stdout, which is read as a stream by tarfile, so the .tar.gz never touches the disk.
 
-        proc = subprocess.Popen(command,stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT) #call the command
-        proc.communicate() #show the stdout and sterr 
-
-    def extract_tar(self, tar_fname, extract_path):
-        """Extract the tar file in the download path to the extract path
-        
         Args:
-        tar_fname (str) : tar filename to extract from the download path
+        tar_full_url (str) : full url to download the tar file
         extract_path (str) : path to extract the tar file to
         """
 
-        print(f"Extracting {tar_fname}")
-        fname = tar_fname
-        command = ['tar','xvf',os.path.join(self.download_path,fname),'-C',extract_path] #define the tar extract command
-        proc = subprocess.Popen(command,stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT) #call the command
-        proc.communicate() #output
-
-    def delete_tar(self, tar_fname):
-        """Delete the tar file in the download path 
-        
-        Args:
-        tar_fname (str) : tar filename to delete from the download path
-        """
+        print(f"Downloading and extracting {tar_full_url} to {extract_path}")
+        if self.data_source == 'https':
+            download_command = ['wget','-q','-O','-',tar_full_url] #create the wget command, writing to stdout
+        elif self.data_source == 'ftp':
+            download_command = ['wget','-q','-O','-',f'--ftp-user={self.credentials["username"]}',f'--ftp-password={self.credentials["password"]}',
+                                tar_full_url] #create the wget command, writing to stdout
 
-        print(f"Deleting {tar_fname}")
-        os.remove(os.path.join(self.download_path,tar_fname))
+        stream_extract(download_command, extract_path)
 
 class Gra2pesDownloadExtra():
     """Class to download and extract GRA2PES extra data provided by Colin
@@ -175,22 +197,20 @@ class Gra2pesDownloadExtra():
         Args:
         sector (str) : sector to download, from the self.config.sectors list
         year (int) : integer year to download
+        mvpath (str, optional) : folder holding an already downloaded tar to extract instead of downloading it. Defaults to None.
         '''
-        if sector not in self.config.sectors:
+        if sector not in self.config.sector_set:
             raise ValueError(f"sector {sector} not found in config")
-        if year not in self.config.years:
+        if year not in self.config.year_set:
             raise ValueError(f"year {year} not found in config")
         
         gen_utils.check_space(self.base_path,excep_thresh='1Tb') #check if there is enough space in the base path
         tar_fname = self.get_tar_filename(sector, year)
         tar_full_url = self.get_tar_url(sector, year)
         if mvpath is None:
-            self.download_tar(tar_full_url)
+            self.stream_extract_tar(tar_full_url) #download and extract in one pass, no tar on disk
         else:
-            old_loc = os.path.join(mvpath,tar_fname)
-            shutil.copy(old_loc, os.path.join(self.download_path, tar_fname))
-        self.extract_tar(tar_fname)
-        self.delete_tar(tar_fname)
+            self.extract_tar(os.path.join(mvpath,tar_fname)) #extract straight from the already downloaded tar, no need to copy it first
 
 
     def get_tar_filename(self, sector, year):
@@ -220,45 +240,34 @@ class Gra2pesDownloadExtra():
         """
 
         filename = self.get_tar_filename(sector, year)
-        return os.path.join(self.base_download_url,filename)
+        return f"{self.base_download_url.rstrip('/')}/{filename}" #urls always use forward slashes, so don't use os.path.join
     
-    def download_tar(self, tar_full_url):
-        """Download the tar file from the full url to the download path
-        
-        Args:
-        tar_full_url (str) : full url to download the tar file
-        """
-
-        print(f"Downloading {tar_full_url} to {self.download_path}")
-
-        command = ['wget',f'--ftp-user={self.credentials["username"]}',f'--ftp-password={self.credentials["password"]}',
-                    tar_full_url,'-P',self.download_path] #create the wget command
+    def stream_extract_tar(self, tar_full_url):
+        """Download the tar file from the full url and extract it on the fly to the download path
 
-        proc = subprocess.Popen(command,stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT) #call the command
-        proc.communicate() #show the stdout and sterr 
+        wget writes the tar to stdout, which is read as a stream by tarfile, so the .tar.gz never touches the disk.
 
-    def extract_tar(self, tar_fname):
-        """Extract the tar file in the download path 
-        
         Args:
-        tar_fname (str) : tar filename to extract from the download path
+        tar_full_url (str) : full url to download the tar file
         """
 
-        print(f"Extracting {tar_fname}")
-        fname = tar_fname
-        command = ['tar','xvf',os.path.join(self.download_path,fname),'-C',self.download_path] #define the tar extract command
-        proc = subprocess.Popen(command,stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT) #call the command
-        proc.communicate() #output
+        print(f"Downloading and extracting {tar_full_url} to {self.download_path}")
+        command = ['wget','-q','-O','-',f'--ftp-user={self.credentials["username"]}',f'--ftp-password={self.credentials["password"]}',
+                    tar_full_url] #create the wget command, writing to stdout
 
-    def delete_tar(self, tar_fname):
-        """Delete the tar file in the download path 
+        stream_extract(command, self.download_path)
+
+    def extract_tar(self, tar_path):
+        """Extract a local tar file to the download path 
         
         Args:
-        tar_fname (str) : tar filename to delete from the download path
+        tar_path (str) : full path to the tar file to extract
         """
 
-        print(f"Deleting {tar_fname}")
-        os.remove(os.path.join(self.download_path,tar_fname))
+        print(f"Extracting {tar_path}")
+        with tarfile.open(tar_path, mode='r|gz') as tar: #stream the tar rather than forking a tar process
+            for member in tar:
+                safe_extract_member(tar, member, self.download_path) #same member checks as the streamed download
 
 
 class OrganizeExtraDownload():
@@ -305,9 +314,19 @@ class OrganizeExtraDownload():
         src (str) : source path to move data from
         dst (str) : destination path to move data to
         dirs_exist_ok (bool) : whether to allow the destination directory to exist, if False, will raise an error if the destination directory
+
+        Raises:
+        FileExistsError : if the destination directory exists and dirs_exist_ok is False
         """
 
-        shutil.copytree(src,dst,dirs_exist_ok=dirs_exist_ok)
+        if os.path.exists(dst) and not dirs_exist_ok:
+            raise FileExistsError(f"Destination directory {dst} already exists")
+
+        for dirpath, dirnames, filenames in os.walk(src): #walk the src, merging it into the dst
+            dst_dir = os.path.join(dst,os.path.relpath(dirpath,src))
+            os.makedirs(dst_dir,exist_ok=True)
+            for fname in filenames: #shutil.move is a rename on the same filesystem, and only falls back to a copy across filesystems
+                shutil.move(os.path.join(dirpath,fname),os.path.join(dst_dir,fname))
 
     def find_multifolder_path(self,src):
         """Find where in the src path there are multiple folders (means where we start the date folder)
@@ -319,12 +338,12 @@ class OrganizeExtraDownload():
         str : path to the parent dir where there are multiple folders
         """
 
-        nitems = len(os.listdir(src)) #number of items in the src path
-        if nitems == 1: #if there is only one item in the src path, go to the next folder
-            newsrc = os.path.join(src,os.listdir(src)[0]) #new src path
-            return self.find_multifolder_path(newsrc) #recursive call
-        else: #if there are multiple items in the src path, return the parent dir
-            return src
+        while True:
+            with os.scandir(src) as it: #scan the src path once per level
+                entries = list(it)
+            if len(entries) != 1: #if there are multiple items in the src path, return the parent dir
+                return src
+            src = entries[0].path #if there is only one item in the src path, go to the next folder
 
     def create_extra_in_base(self,extra_id):
         """Create the extra_id folder in the base_path
@@ -340,6 +359,83 @@ class OrganizeExtraDownload():
         os.makedirs(extra_path, exist_ok=True)
         return extra_path
 
+##################################################################################################################################
+# Define Functions
+
+def stream_extract(download_command, extract_path, timeout=3600):
+    """Run a download command that writes a tar.gz to stdout and extract it on the fly
+
+    If the download fails or the tar is truncated, whatever was extracted from it is deleted before the error is raised, so a
+    rerun doesn't mistake a partial extraction for a finished one.
+
+    Args:
+    download_command (list) : command that writes the tar.gz to stdout (e.g. wget -O -)
+    extract_path (str) : path to extract the tar file to
+    timeout (int) : seconds to wait for the download to exit once the tar has been read, defaults 3600
+
+    Raises:
+    subprocess.CalledProcessError : if the download command exits with a nonzero return code
+    """
+
+    extracted = [] #paths of the files extracted so far, for cleanup on failure
+    download_proc = subprocess.Popen(download_command,stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) #start the download
+    try:
+        with tarfile.open(fileobj=download_proc.stdout, mode='r|gz') as tar: #read the tar as a stream, no seeking back over the file
+            for member in tar: #extract as the bytes arrive
+                if member.isfile():
+                    extracted.append(os.path.join(extract_path, member.name))
+                safe_extract_member(tar, member, extract_path)
+        while download_proc.stdout.read(1 << 20): #drain the padding after the end of the archive so wget exits cleanly rather than on a broken pipe
+            pass
+        download_proc.stdout.close()
+        returncode = download_proc.wait(timeout=timeout)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, download_command[0]) #don't put the command in the error, it can hold credentials
+    except BaseException:
+        download_proc.kill()
+        download_proc.wait()
+        for fpath in extracted: #remove the partial extraction so a restart is clean
+            for path in (fpath, f'{fpath}.part'):
+                if os.path.isfile(path):
+                    os.remove(path)
+        raise
+
+def safe_extract_member(tar, member, extract_path):
+    """Extract one tar member, refusing links and anything that would land outside the extract path
+
+    The parent directory is created with exist_ok first, so threads extracting tars into the same tree don't race on
+    tarfile's own makedirs. Where tarfile has extraction filters the 'data' filter is applied as well. Files are written
+    to a '.part' name and renamed once complete, so a killed extraction never leaves a truncated file under the real name.
+
+    Args:
+    tar (tarfile.TarFile) : open tar the member belongs to
+    member (tarfile.TarInfo) : member to extract
+    extract_path (str) : path to extract the member to
+
+    Raises:
+    ValueError : if the member is a link or its path resolves outside extract_path
+    """
+
+    if member.issym() or member.islnk():
+        raise ValueError(f"Refusing to extract link {member.name} from tar")
+    root = os.path.realpath(extract_path)
+    target = os.path.realpath(os.path.join(root, member.name))
+    if os.path.commonpath([root, target]) != root:
+        raise ValueError(f"Refusing to extract {member.name} outside of {extract_path}")
+    os.makedirs(target if member.isdir() else os.path.dirname(target), exist_ok=True) #exist_ok so concurrent extractions don't collide
+    if member.isfile(): #extract files under a temporary name, renamed below once all of the bytes are written
+        part_member = copy.copy(member)
+        part_member.name = f'{member.name}.part'
+    else:
+        part_member = member
+    if hasattr(tarfile, 'data_filter'): #extraction filters only exist on newer pythons (3.12+ and security backports)
+        tar.extract(part_member, extract_path, filter='data')
+    else:
+        tar.extract(part_member, extract_path)
+    if member.isfile():
+        dest = os.path.join(extract_path, member.name)
+        os.replace(f'{dest}.part', dest)
+
 def compare_base_and_extra(base_path,extra_id):
     """Compare the base and extra directories to make sure they are the same structure
 
@@ -373,6 +469,9 @@ def compare_base_and_extra(base_path,extra_id):
 def compare_dirs_exact(dir1, dir2):
     """Compare two directories exactly, raising an error if they are not the same
 
+    Only the structure (relative paths of all files and folders) is compared, not the file contents, as the main and extra
+    files share names but hold different variables.
+
     Args:
     dir1 (str) : first directory to compare
     dir2 (str) : second directory to compare
@@ -381,20 +480,30 @@ def compare_dirs_exact(dir1, dir2):
     ValueError : if the directories are not the same
     """
 
-    differences = [] #list to store differences
+    tree1 = get_relative_tree(dir1) #all relative paths under dir1
+    tree2 = get_relative_tree(dir2) #all relative paths under dir2
+    left_only = sorted(tree1 - tree2) #paths only in dir1
+    right_only = sorted(tree2 - tree1) #paths only in dir2
 
-    def _compare_dirs(dir1, dir2): #recursive function to compare directories
-        dir_cmp = filecmp.dircmp(dir1, dir2) #compare the directories
-        if dir_cmp.left_only or dir_cmp.right_only: #if there are directories that are only in one directory, add them to the differences list
-            differences.append(f"Directories are not the same:\n{dir1}: {dir_cmp.left_only}\n{dir2}: {dir_cmp.right_only}") 
+    if left_only or right_only: #if there are differences, raise an error
+        raise ValueError(f"Directories are not the same:\n{dir1}: {left_only}\n{dir2}: {right_only}")
 
-        for common_dir in dir_cmp.common_dirs: #for each common directory, recursively call the function
-            _compare_dirs(os.path.join(dir1, common_dir), os.path.join(dir2, common_dir)) 
+def get_relative_tree(root):
+    """Walk a directory once and collect the relative paths of everything below it
+
+    Args:
+    root (str) : directory to walk
 
-    _compare_dirs(dir1, dir2) #call the recursive function
+    Returns:
+    set : relative paths of all files and folders below root
+    """
 
-    if differences: #if there are differences, raise an error
-        raise ValueError("\n".join(differences))
+    rel_paths = set()
+    for dirpath, dirnames, filenames in os.walk(root): #os.walk uses scandir, so no extra stat calls
+        reldir = os.path.relpath(dirpath, root)
+        for name in dirnames + filenames:
+            rel_paths.add(os.path.normpath(os.path.join(reldir, name)))
+    return rel_paths
 
 def main():
     t1 = time.time()
@@ -402,19 +511,14 @@ def main():
     config = gra2pes_config.Gra2pesConfig()
     credentials_path = config.ftp_credentials_path
     main_downloader = Gra2pesDownload(config, data_source='ftp',credentials_path=credentials_path)
-    
-    if os.listdir(main_downloader.download_path):
-        raise ValueError(f"Download path {main_downloader.download_path} is not empty. Please clear the download path before proceeding.")
 
     years = config.years
     months = [1] #config.months
     sectors = ['AG','AVIATION']#config.sectors
+    n_workers = 8 #number of tars to download and extract concurrently
     print(f'Downloading and extracting for years: {years}, months: {months}, sectors: {sectors}')
-    for year in years:
-        for month in months:
-            for sector in sectors:
-                print(f'\nDownloading and extracting {sector} for {year}-{month}')
-                main_downloader.download_extract(sector,year,month)
+    tasks = [(sector,year,month) for year in years for month in months for sector in sectors]
+    main_downloader.download_extract_many(tasks, max_workers=n_workers)
 
     years = [2021]
     sectors = config.sectors
@@ -1,11 +1,42 @@
 import numpy as np
 import os
+import functools
+
+@functools.lru_cache(maxsize=32)
+def _build_grid_out(lat_spacing, lon_spacing, lat_center_range, lon_center_range):
+    """Builds the grid_out arrays for a given spacing and center range, cached so repeat configs share them
+
+    The arrays are set read-only since the same objects are handed to every caller with matching arguments.
+
+    Args:
+        lat_spacing (float) : spacing between latitude center points
+        lon_spacing (float) : spacing between longitude center points
+        lat_center_range (tuple) : (min, max) of the latitude center points
+        lon_center_range (tuple) : (min, max) of the longitude center points
+
+    Returns:
+        dict : dictionary of read-only lat, lon, lat_b, lon_b arrays
+    """
+
+    grid_out = {}
+    for dim, spacing, center_range in (('lat', lat_spacing, lat_center_range), ('lon', lon_spacing, lon_center_range)):
+        n = int(round((center_range[1] - center_range[0]) / spacing)) # Number of center points, upper end of the range is exclusive
+        centers = center_range[0] + spacing * np.arange(n, dtype=np.float64) # Center point spacing, computed from the index to avoid float drift
+        bounds = np.empty(n+1, dtype=np.float64) # Boundary spacing, one more than the centers
+        bounds[:-1] = centers - spacing/2
+        bounds[-1] = centers[-1] + spacing/2
+        grid_out[dim] = centers
+        grid_out[f'{dim}_b'] = bounds
+    for arr in grid_out.values():
+        arr.setflags(write=False)
+    return grid_out
 
 class Gra2pesConfig():
     months = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
     years = [2021]
     day_type_details = {'satdy':[5],'sundy':[6],'weekdy':[0,1,2,3,4]}
-    day_types = list(day_type_details.keys())
+    day_types = tuple(day_type_details) #tuples so callers can't mutate the shared class attribute
+    weekday_day_types = {weekday:day_type for day_type,weekdays in day_type_details.items() for weekday in weekdays} #weekday int -> day type lookup table
     sector_details = {
         'AG' : {'description': 'Agriculture'},
         'AVIATION' : {'description': 'Aviation'},
@@ -27,7 +58,10 @@ class Gra2pesConfig():
         'WASTE' : {'description': 'Waste'},
         'total' : {'description': 'Total'}
     }
-    sectors = list(sector_details.keys())
+    sectors = tuple(sector_details)
+    sector_set = frozenset(sector_details) #frozensets for fast membership checks
+    year_set = frozenset(years)
+    month_set = frozenset(months)
 
     ftp_credentials_path = '/uufs/chpc.utah.edu/common/home/u0890904/credentials/ftp_gra2pes_credentials.txt'
 
@@ -52,32 +86,36 @@ class Gra2pesRegridConfig():
     lon_center_range = (-138.05, -58.95)
     method = 'conservative'
     input_dims=('south_north','west_east')
-    weights_file = 'create'
+    weights_file = 'create' #'create' builds the weights once and caches them in the regridded path, or give a path to an existing weights file
     regrid_id = f'{lat_spacing}x{lon_spacing}'
-    # encoding_details = {
-    #     'zlib': True,              # Use zlib compression
-    #     'complevel': 1,            # Compression level (1 is low, 9 is high)
-    #     'shuffle': True,           # Use the shuffle filter to improve compression
-    #     'chunksizes': ('utc_hour','bottom_top','lat','lon'),  # Set chunk shape to full size for lat lon
-    # }
+    encoding_details = {
+        'zlib': True,              # Use zlib compression
+        'complevel': 1,            # Compression level (1 is low, 9 is high)
+        'shuffle': True,           # Use the shuffle filter to improve compression
+        'chunksizes': (1,'lat','lon'),  # One utc_hour per chunk, full size for lat lon. Must match the dims of the data vars after the pre/post processes
+        'chunk_bytes_range': (1 << 20, 4 << 20),  # Each variable's chunks are resized to hold 1 to 4 MiB where its shape allows
+        'pack_int16': False,       # Pack each variable to int16 with a scale_factor/add_offset over its range. Lossy, smaller files
+    }
 
     def __init__(self,config):
         self.config = config
         self.regridded_path =  self.get_regridded_path()
         self.grid_out = self.get_grid_out()
+        self.weights_path = self.get_weights_path()
 
     def get_grid_out(self):
         """Creates the grid_out dictionary for the regridding process"""
 
-        grid_out = {
-            'lat': np.arange(self.lat_center_range[0], self.lat_center_range[1], self.lat_spacing),  # Center Point Spacing Lat
-            'lon': np.arange(self.lon_center_range[0], self.lon_center_range[1], self.lon_spacing),  # Center Point Spacing Lon
-            'lat_b': np.arange(self.lat_center_range[0]-self.lat_spacing/2, self.lat_center_range[1]+self.lat_spacing/2, self.lat_spacing),  # Boundary Spacing Lat
-            'lon_b': np.arange(self.lon_center_range[0]-self.lon_spacing/2, self.lon_center_range[1]+self.lon_spacing/2, self.lon_spacing),  # Boundary Spacing Lon
-        }
-        return grid_out
+        grid_out = _build_grid_out(self.lat_spacing, self.lon_spacing, tuple(self.lat_center_range), tuple(self.lon_center_range))
+        return dict(grid_out) # Shallow copy so callers can't change the cached dict
     
     def get_regridded_path(self):
         """Gets the regridded path for the regridded data using the config"""
         regridded_path = self.config.regridded_path_structure.format(parent_path=self.config.parent_path,regrid_id=self.regrid_id)
-        return regridded_path
\ No newline at end of file
+        return regridded_path
+
+    def get_weights_path(self):
+        """Gets the path of the regrid weights file, which is reused if it exists and written when the weights are first created"""
+        if self.weights_file == 'create':
+            return os.path.join(self.regridded_path,f'weights_{self.method}_{self.config.base_id}_to_{self.regrid_id}.nc')
+        return self.weights_file
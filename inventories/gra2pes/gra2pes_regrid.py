@@ -16,6 +16,9 @@ import sys
 import time
 import os
 import pickle
+import multiprocessing
+import dask
+from concurrent.futures import ProcessPoolExecutor, as_completed
 sys.path.append(os.path.join(os.path.dirname(__file__),'.'))
 import gra2pes_utils 
 import gra2pes_config
@@ -41,8 +44,12 @@ def create_regrid_subpath(regrid_config,year,month,day_type):
     os.makedirs(regrid_subpath,exist_ok=True) #Make the day type folder if it doesn't exist        
     return regrid_subpath
 
-def load_regrid_save(BGH,gra2pes_regridder,sector,year,month,day_type,pre_processes=None,post_processes=None):
+def load_regrid_save(BGH,gra2pes_regridder,sector,year,month,day_type,pre_processes=None,post_processes=None,overwrite=False):
     """Script to load the base data, regrid it, and save it according to parameter and pre/post processes
+
+    Everything stays lazy until to_netcdf, which computes and writes the data chunk by chunk. Pre and post processes should be
+    plain xarray operations that keep the dataset lazy (no .load() or .values on data variables), so that sums and slices fuse
+    into the dask graph instead of materializing intermediate copies.
     
     Args:
         BGH (BaseGra2pesHandler): The base gra2pes handler
@@ -53,40 +60,87 @@ def load_regrid_save(BGH,gra2pes_regridder,sector,year,month,day_type,pre_proces
         day_type (str): day type (satdy, sundy, weekdy)
         pre_processes (list, optional): List of tuples of functions and keyword parameters to apply to base_ds before regridding. Defaults to None.
         post_processes (list, optional): List of tuples of functions and keyword parameters to apply to regridded_ds after regridding. Defaults to None.
+        overwrite (bool, optional): Whether to redo the regrid if the output already exists. Defaults to False, which skips it so a rerun picks up where it left off.
 
     Returns:
-        xarray.Dataset: The regridded dataset
-
-    Raises:
-        ValueError: If the regridded dataset already exists, this prevents against overwriting data if it has already been regridded and saved
-
+        xarray.Dataset: The regridded dataset, or None if it already existed and was skipped
     """
 
     day_regrid_path = create_regrid_subpath(gra2pes_regridder.regrid_config,year,month,day_type) #Create the regrid subpath
     save_fname = f'{sector}_regridded.nc' #Create the save file name
     full_save_path = os.path.join(day_regrid_path,save_fname) 
-    if os.path.exists(os.path.join(day_regrid_path,save_fname)): 
-        raise ValueError(f"Regridded dataset {full_save_path} already exists, you may end up overwriting data")
+    if os.path.exists(full_save_path) and not overwrite: 
+        print(f'Regridded dataset {full_save_path} already exists, skipping')
+        return None
 
     base_ds = BGH.load_fmt_fullday(sector,year,month,day_type) #Load the base dataset
-
-    if pre_processes: #Apply pre processes
-        for func,params in pre_processes:
-            base_ds = func(base_ds,**params)
+    base_ds = apply_processes(base_ds,pre_processes) #Apply pre processes
 
     regridded_ds = gra2pes_regridder.regrid(base_ds) #Regrid the dataset
     regridded_ds.attrs['git_hash'] = gen_utils.get_githash() #Add the git hash to the attributes
 
-    if post_processes: #Apply post processes
-        for func,params in post_processes:
-            regridded_ds = func(regridded_ds,**params)
+    regridded_ds = apply_processes(regridded_ds,post_processes) #Apply post processes
     
-    print('Loading regridded dataset into memory')
-    regridded_ds.load() #Load the dataset into memory for easier writing 
     print('Saving regridded dataset') 
-    regridded_ds.to_netcdf(full_save_path) #Save the regridded dataset
+    if gra2pes_regridder.regrid_config.encoding_details.get('pack_int16', False):
+        regridded_ds = regridded_ds.load() #Packing needs each variable's min and max, load once so the regrid isn't computed twice
+    encoding = gra2pes_utils.set_ds_encoding(regridded_ds,gra2pes_regridder.regrid_config.encoding_details) #Compress and chunk the data variables
+    tmp_save_path = f'{full_save_path}.tmp' #Write to a temp file and rename so a crash mid write never leaves a partial output that looks finished
+    regridded_ds.to_netcdf(tmp_save_path,encoding=encoding) #Save the regridded dataset, the lazy dataset is computed and written block by block
+    os.replace(tmp_save_path,full_save_path)
     return regridded_ds
 
+def apply_processes(ds,processes):
+    """Apply a list of pre or post processes to a dataset in order
+
+    Args:
+        ds (xarray.Dataset): The dataset
+        processes (list): List of tuples of functions and keyword parameters, or None
+
+    Returns:
+        xarray.Dataset: The processed dataset
+    """
+
+    if processes:
+        for func,params in processes:
+            ds = func(ds,**params)
+    return ds
+
+_worker_state = {} #per-process handler and regridder, built once by _init_worker so each task doesn't rebuild them
+
+def _init_worker(specs,extra_ids,chunks=None):
+    """Initialize a regrid worker process with its own handler and regridder
+
+    Args:
+        specs (list): The species to regrid
+        extra_ids (str or list): The extra ids to include with the base data
+        chunks (dict, optional): The dask chunks to open the base files with. Defaults to None.
+    """
+
+    config = gra2pes_config.Gra2pesConfig()
+    regrid_config = gra2pes_config.Gra2pesRegridConfig(config)
+    _worker_state['BGH'] = gra2pes_utils.BaseGra2pesHandler(config,specs = specs, extra_ids = extra_ids, chunks = chunks)
+    _worker_state['gra2pes_regridder'] = gra2pes_utils.Gra2pesRegridder(regrid_config)
+
+def _regrid_task(task,pre_processes,post_processes,overwrite=False):
+    """Run load_regrid_save for one (sector, year, month, day_type) task in a worker process
+
+    Nothing is returned so the regridded dataset isn't pickled back to the main process.
+
+    Args:
+        task (tuple): (sector, year, month, day_type)
+        pre_processes (list): List of tuples of functions and keyword parameters to apply before the regrid
+        post_processes (list): List of tuples of functions and keyword parameters to apply after the regrid
+        overwrite (bool, optional): Whether to redo the regrid if the output already exists. Defaults to False.
+    """
+
+    sector,year,month,day_type = task
+    gra2pes_regridder = _worker_state['gra2pes_regridder']
+    print(f'Regridding {sector} for {year}-{month} {day_type}')
+    gen_utils.check_space(gra2pes_regridder.regrid_config.regridded_path)
+    load_regrid_save(_worker_state['BGH'],gra2pes_regridder,sector,year,month,day_type,pre_processes=pre_processes,post_processes=post_processes,overwrite=overwrite)
+    print(f'Finished {sector} for {year}-{month} {day_type}\n')
+
 def sum_on_dim(ds,**kwargs):
     """Sum the dataset on a dimension
     
@@ -107,6 +161,47 @@ def sum_on_dim(ds,**kwargs):
         ds = ds.sum(dim=dim)
     return ds
 
+def crop_to_extent(ds,**kwargs):
+    """Crop the base (Lambert) dataset to the grid cells covering an extent, plus a margin
+
+    A typical preprocess step so the regrid only works on the part of the domain that will be kept by slice_extent. The offset of
+    the window and the full domain size are stored in the attrs so Gra2pesRegridder.create_ingrid can rebuild the cell boundaries
+    
+    Args:
+        ds (xarray.Dataset): The base dataset, with 2-D XLAT and XLONG coordinates
+        **kwargs: extent (dict): The extent to crop to
+                  margin_cells (int, optional): Number of extra grid cells to keep on each side so edge cells are fully covered. Defaults to 4.
+        
+    Returns:
+        xarray.Dataset: The dataset cropped to the extent
+
+    Raises:
+        ValueError: If no grid cells fall inside the extent
+    """
+
+    extent = kwargs['extent']
+    margin_cells = kwargs.get('margin_cells',4)
+    lat = ds['XLAT'].values
+    lon = ds['XLONG'].values
+    mask = (lat >= extent['lat_min']) & (lat <= extent['lat_max']) & (lon >= extent['lon_min']) & (lon <= extent['lon_max'])
+    rows = mask.any(axis=1) #south_north indices with a cell in the extent
+    cols = mask.any(axis=0) #west_east indices with a cell in the extent
+    if not rows.any():
+        raise ValueError(f"No grid cells found inside extent {extent}")
+
+    ny, nx = mask.shape
+    i0 = max(int(rows.argmax()) - margin_cells, 0)
+    i1 = min(ny - int(rows[::-1].argmax()) + margin_cells, ny)
+    j0 = max(int(cols.argmax()) - margin_cells, 0)
+    j1 = min(nx - int(cols[::-1].argmax()) + margin_cells, nx)
+
+    ds = ds.isel(south_north=slice(i0,i1), west_east=slice(j0,j1))
+    ds.attrs['full_south_north'] = ny
+    ds.attrs['full_west_east'] = nx
+    ds.attrs['south_north_offset'] = i0
+    ds.attrs['west_east_offset'] = j0
+    return ds
+
 def slice_extent(ds,**kwargs):
     """Slice the dataset to a specific extent
     
@@ -142,11 +237,14 @@ def main():
     months = [1,2,3,4,5,6,7,8,9,10,11,12] #The months to include in the regrid
     years = [2021] #The years to include in the regrid
     day_types = ['satdy','sundy','weekdy'] #The day types to include in the regrid
+    overwrite = False #If False, outputs that already exist are skipped so a crashed run can just be restarted. Set True to redo them
+    chunks = {'Time':1,'bottom_top':-1,'south_north':-1,'west_east':-1} #Dask chunks for the base files, one hour at a time on the full horizontal grid xesmf works on
+    n_workers = 4 #Number of regrid tasks to run in parallel processes, each holds a full day of base data in memory so size this to the node
 
     #Processing parameters (editable)
     pre_sum_dim = 'zlevel' #The dimension to sum on before the regrid (inputs to sum_on_dim)
     extent = {'lon_min': -113, 'lon_max': -111, 'lat_min': 40, 'lat_max': 42} #The extent to slice to after the regrid (inputs to slice_extent)
-    pre_processes = [(sum_on_dim,{'dim':pre_sum_dim})] #List of preprocesses to apply to the base data before the regrid 
+    pre_processes = [(crop_to_extent,{'extent':extent}),(sum_on_dim,{'dim':pre_sum_dim})] #List of preprocesses to apply to the base data before the regrid 
     post_processes = [(slice_extent,{'extent':extent})] #List of postprocesses to apply to the regridded data after the regrid
 
     #Set up the configurations and create the regridded path
@@ -158,7 +256,7 @@ def main():
         sectors = config.sectors
 
     #Create the base gra2pes handler and the regridder
-    BGH = gra2pes_utils.BaseGra2pesHandler(config,specs = specs, extra_ids = extra_ids) 
+    BGH = gra2pes_utils.BaseGra2pesHandler(config,specs = specs, extra_ids = extra_ids, chunks = chunks) 
     gra2pes_regridder = gra2pes_utils.Gra2pesRegridder(regrid_config)
 
     #Print a bunch of stuff to the console
@@ -172,23 +270,27 @@ def main():
     print(f'Sectors: {sectors}')
     print(f'Specs: {specs}')
     print(f'Extra ids: {extra_ids}')
-    print('Pre processes: ','sum_on_dim ',pre_sum_dim)
+    print('Pre processes: ','crop_to_extent ',extent,' sum_on_dim ',pre_sum_dim)
     print('Post processes: ','slice_extent ',extent)
     print('\n')
 
-    #Loop through the sectors, years, months, and day types to regrid the data
-    for year in years:
-        for month in months:
-            for day_type in day_types:
-                for sector in sectors:
-                    print(f'Regridding {sector} for {year}-{month} {day_type}')
-                    gen_utils.check_space(regrid_config.regridded_path)
-                    try:
-                        regridded_ds = load_regrid_save(BGH,gra2pes_regridder,sector,year,month,day_type,pre_processes=pre_processes,post_processes=post_processes)
-                    except Exception as e:
-                        print(f'Error at {time.time()}')
-                        raise Exception(e)
-                    print('')
+    #Create the regridder once up front on the pre processed grid so its weights file exists before the workers start, they all reuse it
+    with dask.config.set(scheduler='synchronous'): #only the grid coordinates are computed here, so don't start dask's thread pool in the parent
+        grid_ds = apply_processes(BGH.load_fmt_fullday(sectors[0],years[0],months[0],day_types[0]),pre_processes)
+        gra2pes_regridder.create_regridder(grid_ds, save_to_self = True)
+
+    #Regrid each sector, year, month, and day type in parallel worker processes
+    tasks = [(sector,year,month,day_type) for year in years for month in months for day_type in day_types for sector in sectors]
+    mp_context = multiprocessing.get_context('spawn') #spawn fresh workers, forked ones inherit dask's thread pool without its threads and hang on their first compute
+    with ProcessPoolExecutor(max_workers=n_workers,mp_context=mp_context,initializer=_init_worker,initargs=(specs,extra_ids,chunks)) as executor:
+        futures = {executor.submit(_regrid_task,task,pre_processes,post_processes,overwrite):task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f'Error at {time.time()} regridding {futures[future]}')
+                executor.shutdown(wait=False,cancel_futures=True) #don't start any more tasks
+                raise Exception(e)
 
     #Create a folder to hold details about the regrid and other files
     details_path = os.path.join(regrid_config.regridded_path,'details') #Create the details path
@@ -196,7 +298,7 @@ def main():
 
     #Get some final stuff to put in the regrid details
     print('Creating example ds for grid cell area')
-    base_ds = BGH.load_fmt_fullday(sectors[0],years[0],months[0],day_types[0]) #Load the very first base dataset
+    base_ds = apply_processes(BGH.load_fmt_fullday(sectors[0],years[0],months[0],day_types[0]),pre_processes) #Load the very first base dataset, on the same grid the regridder was built for
     regridded_ds = gra2pes_regridder.regrid(base_ds) #Regrid it
     example_ds = regridded_ds.isel(utc_hour = 0).drop_vars('utc_hour')[list(regridded_ds.data_vars.keys())[0]] #Pare it all the way down to just lat lon and one species
     example_ds.to_netcdf(os.path.join(details_path,'grid_out.nc')) #Save the example ds
@@ -212,7 +314,7 @@ def main():
         f.write(f'Sectors: {sectors}\n')
         f.write(f'Specs: {specs}\n')
         f.write(f'Extra ids: {extra_ids}\n')
-        f.write(f'Pre processes: sum_on_dim {pre_sum_dim}\n')
+        f.write(f'Pre processes: crop_to_extent {extent} sum_on_dim {pre_sum_dim}\n')
         f.write(f'Post processes: slice_extent {extent}\n')
     with open(os.path.join(details_path,'regrid_config.pkl'),'wb') as f:  #Save the regrid config to a pickle file
         pickle.dump(regrid_config,f)
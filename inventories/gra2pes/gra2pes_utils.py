@@ -1,5 +1,6 @@
 import os
-import warnings
+import functools
+import hashlib
 import pyproj
 import calendar
 import datetime
@@ -11,21 +12,25 @@ import pandas as pd
 sys.path.append(os.path.join(os.path.dirname(__file__),'../..'))
 from utils import datetime_utils
 
-# Suppress the specific FutureWarning
-warnings.filterwarnings("ignore", category=FutureWarning, message="The return type of `Dataset.dims` will be changed")
-
 def set_ds_encoding(ds, encoding_details, vars_to_set = 'all'):
     """Set the encoding details for a dataset
+
+    If encoding_details has 'pack_int16' set, each data variable is packed to int16 with a scale_factor and add_offset spanning
+    its min and max. This is lossy (about 1/65534 of the variable's range) and needs a pass over the data for the min and max,
+    so the dataset should be loaded first. Variables without a finite min and max (e.g. all NaN) are left unpacked. Chunk sizes
+    are then fit per variable to the 'chunk_bytes_range' (see fit_chunksizes). Variables whose number of dims doesn't match
+    'chunksizes' get no chunksizes in their encoding.
     
     Args:
         ds (xr.Dataset) : the dataset to set the encoding details for
         encoding_details (dict) : the encoding details to set
+        vars_to_set (str or list) : the variables to set the encoding for. If 'all', all data variables will be set
     
     Returns:
-        xr.Dataset : the dataset with the encoding details set
+        dict : the encoding for each variable, to pass to to_netcdf
     """
     if vars_to_set == 'all':
-        vars_to_set = ds.variables
+        vars_to_set = list(ds.data_vars)
 
     dim_sizes = ds.sizes
     # Resolve chunksizes
@@ -33,17 +38,84 @@ def set_ds_encoding(ds, encoding_details, vars_to_set = 'all'):
         dim_sizes[dim] if isinstance(dim, str) and dim in dim_sizes else dim for dim in encoding_details['chunksizes']
     )
 
-    encoding = {}
-    for var in ds.data_vars:
-        encoding[var] = {
-            'zlib': encoding_details['zlib'],
-            'complevel': encoding_details['complevel'],
-            'shuffle': encoding_details['shuffle'],
-            'chunksizes': resolved_chunksizes,
-        }
+    base_encoding = {
+        'zlib': encoding_details['zlib'],
+        'complevel': encoding_details['complevel'],
+        'shuffle': encoding_details['shuffle'],
+        'chunksizes': resolved_chunksizes,
+    }
+    encoding = {var: dict(base_encoding) for var in vars_to_set} # Shallow copies, the chunks and packing below are set per variable
+
+    if encoding_details.get('pack_int16', False):
+        stats = xr.concat([ds[vars_to_set].min(), ds[vars_to_set].max()], dim='stat').compute() #min and max of every variable in one pass
+        for var in vars_to_set:
+            vmin, vmax = float(stats[var][0]), float(stats[var][1])
+            if not (np.isfinite(vmin) and np.isfinite(vmax)): #all NaN (or inf) variables have no range to pack, leave them as is
+                continue
+            scale_factor = (vmax - vmin) / 65534 if vmax > vmin else 1.0 #map [vmin,vmax] onto [-32767,32767], -32768 is the fill value
+            encoding[var].update({
+                'dtype': 'int16',
+                'scale_factor': scale_factor,
+                'add_offset': (vmax + vmin) / 2,
+                '_FillValue': -32768,
+            })
+
+    min_bytes, max_bytes = encoding_details.get('chunk_bytes_range', (1 << 20, 4 << 20))
+    for var in encoding: # Size each variable's chunks for its own shape and on disk dtype
+        if len(encoding[var]['chunksizes']) == ds[var].ndim:
+            itemsize = np.dtype(encoding[var].get('dtype', ds[var].dtype)).itemsize
+            encoding[var]['chunksizes'] = fit_chunksizes(encoding[var]['chunksizes'], ds[var].shape, itemsize, min_bytes, max_bytes)
+        else: # The configured chunks don't fit this variable's dims (e.g. zlevel wasn't summed), let netCDF pick its chunks
+            del encoding[var]['chunksizes']
         
     return encoding
 
+def fit_chunksizes(chunksizes, shape, itemsize, min_bytes, max_bytes):
+    """Adjust netCDF chunk sizes so each chunk holds between min_bytes and max_bytes where the shape allows
+    
+    Chunks that are too big are shrunk by halving their largest axis, and chunks that are too small are grown by doubling the
+    first axis that isn't already full size (for the regridded data, that is utc_hour).
+
+    Args:
+        chunksizes (tuple) : the starting chunk sizes, one per dimension
+        shape (tuple) : the shape of the variable
+        itemsize (int) : bytes per element as stored on disk
+        min_bytes (int) : smallest chunk size to aim for, in bytes
+        max_bytes (int) : largest chunk size to aim for, in bytes
+
+    Returns:
+        tuple : the adjusted chunk sizes
+    """
+
+    chunks = [max(1, min(int(c), n)) for c, n in zip(chunksizes, shape)]
+    while int(np.prod(chunks)) * itemsize > max_bytes and max(chunks) > 1:
+        axis = int(np.argmax(chunks))
+        chunks[axis] = (chunks[axis] + 1) // 2
+    for axis, n in enumerate(shape):
+        while int(np.prod(chunks)) * itemsize < min_bytes and chunks[axis] < n:
+            chunks[axis] = min(chunks[axis] * 2, n)
+            if int(np.prod(chunks)) * itemsize > max_bytes: # Don't overshoot the other way
+                chunks[axis] = max(chunks[axis] // 2, 1)
+                break
+    return tuple(chunks)
+
+@functools.lru_cache(maxsize=8)
+def _transformers_from_proj4(proj4_str):
+    """Create the WGS to LCC and LCC to WGS transformers for a proj4 string, cached since building them parses the projection
+    
+    Args:
+        proj4_str (str) : a proj4 string defining the lcc projection
+    
+    Returns:
+        tuple : (wgs_to_lcc, lcc_to_wgs) pyproj.Transformer objects
+    """
+
+    lcc_crs = pyproj.CRS.from_proj4(proj4_str) #define the lcc coordinate reference system using the proj4 string
+    wgs_crs = pyproj.CRS.from_epsg(4326) #define wgs coordinates as espg 4326
+    wgs_to_lcc = pyproj.Transformer.from_crs(wgs_crs,lcc_crs,always_xy=True) #create one transformer
+    lcc_to_wgs = pyproj.Transformer.from_crs(lcc_crs,wgs_crs,always_xy=True) #create the other transformer
+    return wgs_to_lcc, lcc_to_wgs
+
 def get_daytype_from_int(day_int,config):
     """Get the day type from an integer
     
@@ -54,10 +126,10 @@ def get_daytype_from_int(day_int,config):
     Returns:
         str : the day type
     """
-    for day_type,intlist in config.day_type_details.items():
-        if day_int in intlist:
-            return day_type
-    raise ValueError(f"Day type {day_int} not found in config")
+    try:
+        return config.weekday_day_types[day_int]
+    except KeyError:
+        raise ValueError(f"Day type {day_int} not found in config")
 
 def get_inrange_list(dtr,config):
     '''Gets all unique year/month/daytype combinations in a datetime range
@@ -92,22 +164,24 @@ class BaseGra2pesHandler():
         base_path (str) : the base path to the GRA2PES files, as defined in the config
         specs (str or list) : the variables to load from the files. If 'all', all variables will be loaded
         extra_ids (list) : list of extra ids to load in addition to the main file, as of now only "methane" is applicable
+        chunks (dict) : default dask chunks passed to xarray.open_dataset when loading files
     """
 
-    def __init__(self, config, specs='all', extra_ids=None):
+    def __init__(self, config, specs='all', extra_ids=None, chunks=None):
         self.config = config
         self.base_path = config.base_path
         self.specs = specs
-        if extra_ids == None:
+        self.chunks = {} if chunks is None else chunks
+        if extra_ids is None:
             self.extra_ids = []
-        elif type(extra_ids) == list:
-            self.extra_ids = extra_ids
-        elif type(extra_ids) == str:
+        elif isinstance(extra_ids, str):
             self.extra_ids = [extra_ids]
+        elif isinstance(extra_ids, (list, tuple)):
+            self.extra_ids = list(extra_ids)
         else:
-            raise ValueError("extra_ids must be a list, string, or None")
+            raise ValueError("extra_ids must be a list, tuple, string, or None")
     
-    def load_fmt_fullday(self, sector, year, month, day_type, chunks = {}, check_extra = True):
+    def load_fmt_fullday(self, sector, year, month, day_type, chunks = None, check_extra = True, deep_check = False):
         """Load the full day of data for a given sector, year, month, and day type
         
         Args:
@@ -115,22 +189,26 @@ class BaseGra2pesHandler():
             year (int) : the year to load
             month (int) : the month to load
             day_type (str) : the day type to load
-            chunks (dict) : dictionary of chunks to pass to xarray.open_dataset
+            chunks (dict) : dictionary of chunks to pass to xarray.open_dataset, defaults to the handler's chunks
             check_extra (bool) : whether to check the extra datasets against the main dataset ensuring the same varibles, coordinates, and attributes
+            deep_check (bool) : whether the extra check compares every value of the shared variables, see check_extra_against_main. Defaults False
         
         Returns:
             xr.Dataset : the full dataset for the given sector, year, month, and day type
         """
 
+        if chunks is None:
+            chunks = self.chunks
+
         ds_list = []
         for hour_start in ['00','12']: # Load the two half-day files
-            ds = self.load_fmt_single(sector, year, month, day_type, hour_start, chunks, check_extra) 
+            ds = self.load_fmt_single(sector, year, month, day_type, hour_start, chunks, check_extra, deep_check = deep_check)
             ds_list.append(ds)
-        full_ds = xr.concat(ds_list, dim='utc_hour') # Concatenate the two half-day files
-        full_ds = self.rename_zlevel(full_ds) # Rename the zlevel coordinate
+        full_ds = xr.concat(ds_list, dim='Time', data_vars='minimal', coords='minimal', compat='override', join='override') # Concatenate the two half-day files. They share every coordinate but Time, so skip the alignment and equality checks
+        full_ds = self.rename_time_zlevel(full_ds) # Change Time to utc_hour and bottom_top to zlevel in one go
         return full_ds
 
-    def load_fmt_single(self, sector, year, month, day_type, hour_start, chunks, check_extra):
+    def load_fmt_single(self, sector, year, month, day_type, hour_start, chunks, check_extra, deep_check = False):
         """Load a single half-day file for a given sector, year, month, day type, and hour start, along with any extra files
 
         Args:
@@ -141,9 +219,10 @@ class BaseGra2pesHandler():
             hour_start (str) : the hour start to load ('00' or '12')
             chunks (dict) : dictionary of chunks to pass to xarray.open_dataset
             check_extra (bool) : whether to check the extra datasets against the main dataset ensuring the same varibles, coordinates, and attributes
+            deep_check (bool) : whether the extra check compares every value of the shared variables, see check_extra_against_main. Defaults False
 
         Returns:
-            xr.Dataset : the dataset for the given sector, year, month, day type, and hour start
+            xr.Dataset : the dataset for the given sector, year, month, day type, and hour start, still on the file's Time and bottom_top dims
         """
 
         # Get the relative file path (will be the same for both main and extra, with the addition of the extra id)
@@ -154,21 +233,24 @@ class BaseGra2pesHandler():
         main_ds = xr.open_dataset(main_full_fpath, chunks=chunks)
 
         # Load the extra files
-        extra_ds = {}
+        extra_vars = {}
         for extra_id in self.extra_ids:
             extra_full_fpath = os.path.join(self.base_path,extra_id,relpath_fname)
             extra_ds = xr.open_dataset(extra_full_fpath, chunks=chunks)
+            new_vars = self.get_extra_vars(main_ds, extra_ds)
             if check_extra:
-                self.check_extra_against_main(main_ds, extra_ds)
-            extra_vars = self.get_extra_vars(main_ds, extra_ds)
-            main_ds = xr.merge([main_ds, extra_ds[extra_vars]])
+                self.check_extra_against_main(main_ds, extra_ds, deep_check = deep_check, extra_vars = new_vars)
+            for var in new_vars:
+                extra_vars[var] = extra_ds[var]
 
-        # Select the desired variables
+        # Select the desired variables before adding the extras, so unwanted species are never carried along
         if self.specs != 'all':
-            main_ds = main_ds[self.specs]
-
-        # Change the time to utc_hour for clarity
-        main_ds = self.change_time_to_utc_hour(main_ds)
+            main_ds = main_ds[[spec for spec in self.specs if spec in main_ds.data_vars]]
+            extra_vars = {var:da for var,da in extra_vars.items() if var in self.specs}
+        for var,da in extra_vars.items(): # Assign directly rather than xr.merge, the grids were checked to match so there's nothing to align
+            main_ds[var] = da
+        if self.specs != 'all':
+            main_ds = main_ds[self.specs] # Put the species in the requested order, and raise if any weren't found
 
         # Oranize and add some attributes
         main_ds.attrs['sector'] = sector
@@ -221,56 +303,62 @@ class BaseGra2pesHandler():
             set : the set of extra variables in the extra dataset
         """
 
-        extra_vars = set(extra_ds.variables) - set(main_ds.variables)
+        extra_vars = extra_ds.variables.keys() - main_ds.variables.keys() # set difference straight on the key views
         return extra_vars
 
-    def check_extra_against_main(self, main_ds, extra_ds):
+    def check_extra_against_main(self, main_ds, extra_ds, deep_check = False, extra_vars = None):
         """Check that the extra dataset matches the main dataset in terms of variables, attributes, and coordinates, dimensions
 
+        By default the shared data variables are checked for matching dims, shape and dtype, and their values are only compared on
+        a sample (the first and last slice along the leading dims), since comparing every value reads all of them from disk.
+        Coordinates are always compared by value.
+
         Args:
             main_ds (xr.Dataset) : the main dataset
             extra_ds (xr.Dataset) : the extra dataset
+            deep_check (bool) : whether to compare every value of the shared data variables instead of a sample, defaults False
+            extra_vars (set) : the extra variables from get_extra_vars, used in the error messages. Found if not given
 
         Raises:
             AssertionError : if the extra dataset does not match the main dataset
         """
 
-        attrs_equal = main_ds.attrs == extra_ds.attrs # Check that the attributes are the same
-        dims_equal = main_ds.dims == extra_ds.dims # Check that the dimensions are the same
-        coord_keys_equal = main_ds.coords.keys() == extra_ds.coords.keys() # Check that the coordinate keys are the same
-        coord_values_equal = all([main_ds.coords[key].equals(extra_ds.coords[key]) for key in main_ds.coords.keys()]) # Check that the coordinate values are the same
-        extra_vars = self.get_extra_vars(main_ds, extra_ds) # Get the extra variables
-        shared_vars = set(main_ds.variables) & set(extra_ds.variables) # Get the shared variables
-        xr.testing.assert_equal(main_ds[shared_vars], extra_ds[shared_vars]) # Check that the shared variables are equal
-
-        # Raise an error if any of the checks fail
-        assert attrs_equal and dims_equal and coord_keys_equal and coord_values_equal, f"Extra dataset does not match main dataset. Extra variables: {extra_vars}"
+        if extra_vars is None:
+            extra_vars = self.get_extra_vars(main_ds, extra_ds) # Get the extra variables
+        assert main_ds.attrs == extra_ds.attrs, f"Extra dataset attributes do not match main dataset. Extra variables: {extra_vars}" # Check that the attributes are the same
+        assert dict(main_ds.sizes) == dict(extra_ds.sizes), f"Extra dataset dimensions do not match main dataset. Extra variables: {extra_vars}" # Check that the dimensions are the same
+        assert main_ds.coords.keys() == extra_ds.coords.keys(), f"Extra dataset coordinates do not match main dataset. Extra variables: {extra_vars}" # Check that the coordinate keys are the same
+        for key in main_ds.coords.keys(): # Check that the coordinate values are the same, stopping at the first mismatch
+            assert main_ds.coords[key].equals(extra_ds.coords[key]), f"Extra dataset coordinate {key} does not match main dataset"
+
+        shared_data_vars = set(main_ds.data_vars) & set(extra_ds.data_vars) # Get the shared data variables
+        for var in shared_data_vars: # Cheap metadata check on the shared data variables
+            main_var, extra_var = main_ds[var], extra_ds[var]
+            assert main_var.dims == extra_var.dims and main_var.shape == extra_var.shape and main_var.dtype == extra_var.dtype, f"Extra dataset variable {var} does not match main dataset"
+            if not deep_check: # Compare the values on the first and last slice along the leading dims, only a few slices are read
+                for idx in (0, -1):
+                    sample = {dim: idx for dim in main_var.dims[:-2]}
+                    assert np.array_equal(main_var.isel(sample).values, extra_var.isel(sample).values, equal_nan = True), f"Extra dataset variable {var} does not match main dataset"
+        if deep_check:
+            xr.testing.assert_equal(main_ds[list(shared_data_vars)], extra_ds[list(shared_data_vars)]) # Check that the shared variables are equal
     
-    def change_time_to_utc_hour(self, ds):
-        """Change the time coordinate from a datetime on the first day of each month to utc_hour integer for clarity
+    def rename_time_zlevel(self, ds):
+        """Change the time coordinate from a datetime on the first day of each month to utc_hour integer for clarity, and rename
+        bottom_top to zlevel, with a single rename
 
         Args:
-            ds (xr.Dataset) : the dataset to change the time coordinate of
+            ds (xr.Dataset) : the dataset to change the coordinates of
 
         Returns:
-            xr.Dataset : the dataset with the time coordinate changed to utc_hour as an int
+            xr.Dataset : the dataset with utc_hour as an int and zlevel in place of Time and bottom_top
         """
 
-        ds['Time'] = ds['Time'].dt.hour
-        ds = ds.rename({'Time':'utc_hour'})
-        return ds
-
-    def rename_zlevel(self,ds):
-        """Rename the zlevel coordinate from bottom_top to zlevel
-        
-        Args:
-            ds (xr.Dataset) : the dataset to rename the zlevel coordinate of
-        
-        Returns:
-            xr.Dataset : the dataset with the bottom_top coordinate renamed to zlevel
-        """
-
-        ds = ds.rename({'bottom_top':'zlevel'})
+        times = ds['Time'].values
+        if np.issubdtype(times.dtype, np.datetime64): # Get the hour straight from the datetime64 values, no pandas accessor
+            hours = times.astype('datetime64[h]').astype(np.int64) % 24
+        else: # Fall back to the accessor for non standard (cftime) calendars
+            hours = ds['Time'].dt.hour.values
+        ds = ds.assign_coords(Time=hours).rename({'Time':'utc_hour','bottom_top':'zlevel'})
         return ds
 
 class Gra2pesRegridder():
@@ -282,6 +370,7 @@ class Gra2pesRegridder():
     Methods:
         regrid : regrid a dataset
         create_regridder : create a regridder object
+        get_weights_path : get the weights file path for an input dataset
         create_ingrid : create the input grid for the regridder
         create_transformers : create the transformers for going from lambert conformal to WGS and vice versa
         proj4_from_ds : get a proj4 string defining a projection from a gra2pes "base" dataset
@@ -308,15 +397,8 @@ class Gra2pesRegridder():
         
         #print('Regridding')
         regridded_ds = self.regridder(ds,keep_attrs = True) #regrid the dataset using the regridder
-        old_attrs = list(regridded_ds.attrs.keys()) #get the old attributes 
-        keep_attrs = ['sector','year','month','day_type','TITLE','regrid_method'] #attributes to keep
-
-        #remove all attributes that aren't in the keep_attrs list
-        for attr in old_attrs: 
-            if attr not in keep_attrs:
-                del regridded_ds.attrs[attr]
-            else:
-                continue
+        keep_attrs = ('sector','year','month','day_type','TITLE','regrid_method') #attributes to keep
+        regridded_ds.attrs = {attr:regridded_ds.attrs[attr] for attr in keep_attrs if attr in regridded_ds.attrs} #drop all the others
 
         return regridded_ds
 
@@ -336,8 +418,17 @@ class Gra2pesRegridder():
         grid_out = self.regrid_config.grid_out #get the output grid from the regrid config
         method = self.regrid_config.method 
         input_dims = self.regrid_config.input_dims
-
-        regridder = xe.Regridder(grid_in, grid_out, method, input_dims = input_dims) #create the regridder
+        weights_path = self.get_weights_path(ds)
+        reuse_weights = os.path.exists(weights_path) #the base grid is the same for every sector and date, so weights only need computing once
+
+        if reuse_weights:
+            print(f'Reusing regrid weights from {weights_path}')
+        regridder = xe.Regridder(grid_in, grid_out, method, input_dims = input_dims, filename = weights_path, reuse_weights = reuse_weights) #create the regridder
+        if not reuse_weights:
+            os.makedirs(os.path.dirname(weights_path), exist_ok=True)
+            tmp_path = f'{weights_path}.{os.getpid()}.tmp' #write to a temp file and rename so parallel workers never see a partial file
+            regridder.to_netcdf(tmp_path)
+            os.replace(tmp_path, weights_path)
 
         regridder.ds_attrs = ds.attrs #save the attributes of the dataset to the regridder
 
@@ -346,6 +437,36 @@ class Gra2pesRegridder():
 
         return regridder
 
+    def get_weights_path(self, ds):
+        """Get the weights file path for a dataset, tagged with the crop window if the dataset was cropped before the regrid
+
+        When the config creates its own weights, the name also gets a short hash of the input grid (shape and corner points) and
+        the output grid spec. A change to either then gets new weights instead of reusing a stale file. A weights file given in
+        the config is used as is.
+
+        Args:
+            ds (xr.Dataset) : the dataset the regridder is built from
+
+        Returns:
+            str : path to the weights file for this input grid
+        """
+
+        regrid_config = self.regrid_config
+        weights_path = regrid_config.weights_path
+        if regrid_config.weights_file != 'create': #user given weights file
+            return weights_path
+        root, ext = os.path.splitext(weights_path)
+        if 'south_north_offset' in ds.attrs: #cropped, tag with the crop window
+            i0, j0 = ds.attrs['south_north_offset'], ds.attrs['west_east_offset']
+            i1, j1 = i0 + ds.sizes['south_north'], j0 + ds.sizes['west_east']
+            root = f'{root}_sn{i0}-{i1}_we{j0}-{j1}'
+        corners = {'south_north':[0,-1], 'west_east':[0,-1]}
+        grid_key = (ds['XLAT'].shape, ds['XLAT'].isel(corners).values.round(6).tolist(), ds['XLONG'].isel(corners).values.round(6).tolist(),
+                    regrid_config.method, regrid_config.lat_spacing, regrid_config.lon_spacing,
+                    tuple(regrid_config.lat_center_range), tuple(regrid_config.lon_center_range))
+        grid_hash = hashlib.md5(repr(grid_key).encode()).hexdigest()[:8] #not for security, just a short stable fingerprint
+        return f'{root}_{grid_hash}{ext}'
+
     def create_ingrid(self, ds):
         """Creates the grid that will be input into the regridder from a "base" gra2pes dataset. Adapted from Colin Harkins at NOAA
         
@@ -362,16 +483,20 @@ class Gra2pesRegridder():
         # Calculate the easting and northings of the domain center point
         e,n = wgs_to_lcc.transform(ds.CEN_LON, ds.CEN_LAT) #use the attribributes to transform lat lons defined in the ds as center to lcc
 
-        # Grid parameters from the dataset
+        # Grid parameters from the dataset. If it was cropped (see gra2pes_regrid.crop_to_extent), the full domain size and the offset of the window are in the attrs
         dx, dy = ds.DX, ds.DY 
-        nx, ny = ds.dims['west_east'], ds.dims['south_north']
+        nx, ny = ds.sizes['west_east'], ds.sizes['south_north']
+        full_nx, full_ny = ds.attrs.get('full_west_east', nx), ds.attrs.get('full_south_north', ny)
+        j0, i0 = ds.attrs.get('west_east_offset', 0), ds.attrs.get('south_north_offset', 0)
 
-        # bottom left corner of the domain
-        x0 = -(nx-1) / 2. * dx + e
-        y0 = -(ny-1) / 2. * dy + n
+        # bottom left corner of the domain (or of the cropped window)
+        x0 = -(full_nx-1) / 2. * dx + e + j0 * dx
+        y0 = -(full_ny-1) / 2. * dy + n + i0 * dy
 
         # Calculating the boundary X-Y Coordinates
-        x_b, y_b = np.meshgrid(np.arange(nx+1) * dx + x0 -dx/2, np.arange(ny+1) * dy + y0 -dy/2)
+        xs = np.arange(nx+1, dtype=np.float64) * dx + (x0 - dx/2)
+        ys = np.arange(ny+1, dtype=np.float64) * dy + (y0 - dy/2)
+        x_b, y_b = np.broadcast_arrays(xs[None,:], ys[:,None]) #read-only 2-D views, pyproj copies them into its own buffers anyway
         x_bc, y_bc = lcc_to_wgs.transform(x_b, y_b)
 
         #define the input grid
@@ -396,12 +521,7 @@ class Gra2pesRegridder():
         """
 
         proj4_str = self.proj4_from_ds(ds) #get the proj4 string from the dataset
-        lcc_crs = pyproj.CRS.from_proj4(proj4_str) #define the lcc coordinate reference system using the proj4 string
-        wgs_crs = pyproj.CRS.from_epsg(4326) #define wgs coordinates as espg 4326
-        wgs_to_lcc = pyproj.Transformer.from_crs(wgs_crs,lcc_crs,always_xy=True) #create one transformer
-        lcc_to_wgs = pyproj.Transformer.from_crs(lcc_crs,wgs_crs,always_xy=True) #create the other transformer
-
-        return wgs_to_lcc, lcc_to_wgs
+        return _transformers_from_proj4(proj4_str) #every base file shares the projection, so the transformers are built once per process
 
     def proj4_from_ds(self,ds,map_proj = None, earth_rep = 'sphere'):
         """Get a proj4 string defining a projection from a gra2pes "base" dataset 
@@ -415,7 +535,7 @@ class Gra2pesRegridder():
             str : a proj4 string defining the projection
         """
          
-        if map_proj == None: #if the user didn't define a map projection
+        if map_proj is None: #if the user didn't define a map projection
             try: #try it so we can catch bad ones
                 if ds.MAP_PROJ_CHAR == 'Lambert Conformal': #teh datasets from noaa_csl "base" data should have the "Lambert Conformal" attribute, so confirm this
                     map_proj = 'lcc' #if so, the map_proj code is lcc
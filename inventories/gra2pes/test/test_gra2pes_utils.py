@@ -0,0 +1,37 @@
+import os
+import sys
+import numpy as np
+import xarray as xr
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+import gra2pes_utils
+
+encoding_details = {
+    'zlib': True,
+    'complevel': 1,
+    'shuffle': True,
+    'chunksizes': (1,'lat','lon'),
+    'pack_int16': True,
+}
+
+def test_set_ds_encoding_pack_int16_all_nan():
+    ds = xr.Dataset({'CO2': (('utc_hour','lat','lon'), np.arange(24.).reshape(2,3,4)),
+                     'CH4': (('utc_hour','lat','lon'), np.full((2,3,4), np.nan))})
+    encoding = gra2pes_utils.set_ds_encoding(ds, encoding_details)
+    assert encoding['CO2']['dtype'] == 'int16'
+    assert encoding['CO2']['add_offset'] == 11.5
+    assert 'dtype' not in encoding['CH4']
+    assert 'add_offset' not in encoding['CH4']
+
+def test_set_ds_encoding_chunksizes_ndim_mismatch():
+    ds = xr.Dataset({'CO2': (('utc_hour','zlevel','lat','lon'), np.zeros((2,2,3,4)))})
+    encoding = gra2pes_utils.set_ds_encoding(ds, dict(encoding_details, pack_int16 = False))
+    assert 'chunksizes' not in encoding['CO2']
+    assert encoding['CO2']['zlib']
+
+
+def main():
+    test_set_ds_encoding_pack_int16_all_nan()
+    test_set_ds_encoding_chunksizes_ndim_mismatch()
+
+if __name__ == "__main__":
+    main()
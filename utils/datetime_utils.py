@@ -6,8 +6,23 @@ Classes:
 """
 
 import datetime
+import functools
 import pytz
 import dateutil 
+import pandas as pd
+
+@functools.lru_cache(maxsize=None)
+def _get_tz(tz_name):
+    """Get a pytz timezone from its name, cached since DateTimeRanges are often built in loops
+
+    Args:
+        tz_name (str): Name of the timezone (e.g. 'UTC', 'US/Mountain').
+
+    Returns:
+        pytz.tzinfo.BaseTzInfo: The timezone object.
+    """
+
+    return pytz.timezone(tz_name)
 
 class DateTimeRange():
     """Class for handling datetime ranges.
@@ -23,7 +38,7 @@ class DateTimeRange():
         if isinstance(tz, pytz.tzinfo.BaseTzInfo):
             self.tz = tz
         else:
-            self.tz = pytz.timezone(tz)
+            self.tz = _get_tz(tz)
 
         self.start_dt = self._parse_datetime(start_dt)
         self.end_dt = self._parse_datetime(end_dt)
@@ -42,7 +57,10 @@ class DateTimeRange():
         """
 
         if isinstance(dt, str): #Check if it's a string
-            dt = dateutil.parser.parse(dt) #Parse the string
+            try:
+                dt = datetime.datetime.fromisoformat(dt) #Fast path for ISO 8601 strings like '2021-01-01 00:00:00'
+            except ValueError:
+                dt = dateutil.parser.parse(dt) #Fall back to the general parser for anything else
         
         if dt.tzinfo is None: #If the datetime object has no timezone
             dt = self.tz.localize(dt) #Add the timezone
@@ -62,15 +80,13 @@ class DateTimeRange():
             list: List of dates in the datetime range.
         """
 
-        dates = [] #List to store the dates
-        current_date = self.start_dt #Start from the start date
-        while current_date <= self.end_dt: #While the current date is less than or equal to the end date
-            if fmt == None: #If no format is specified
-                dates.append(current_date.date()) #Append the date as a datetime.date object
-            elif type(fmt) == str: #If a format is specified
-                dates.append(current_date.strftime(fmt)) #Append the date as a string with the specified format
-            current_date += datetime.timedelta(days=1) #Increment the current date by one day
-        return dates
+        n_days = max((self.end_dt - self.start_dt) // datetime.timedelta(days=1) + 1, 0) #Number of whole days from the start that are still <= the end
+        days = pd.date_range(self.start_dt.date(), periods=n_days, freq='D') #Every day from the start date, built from the naive date so DST shifts can't make a day nonexistent or ambiguous
+        if fmt is None: #If no format is specified
+            return list(days.date) #The dates as datetime.date objects
+        elif isinstance(fmt, str): #If a format is specified
+            return days.strftime(fmt).tolist() #The dates as strings with the specified format
+        return []
 
     def new_tz(self,tz):
         """
@@ -86,8 +102,8 @@ class DateTimeRange():
             ValueError: If the timezone is not a string or a timezone object.
         """
 
-        if type(tz) == str: #If the timezone is a string
-            tz = pytz.timezone(tz) #Get the timezone object
+        if isinstance(tz, str): #If the timezone is a string
+            tz = _get_tz(tz) #Get the timezone object
         elif not isinstance(tz,pytz.tzinfo.BaseTzInfo): #If the timezone is not a string or a timezone object
             raise ValueError(f"Invalid timezone: {tz}") #Raise an error
 
@@ -6,9 +6,9 @@ Functions:
 """
 
 import pandas as pd
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
-def remove_rolling_outliers(df, window = '1h', columns='all', std_thresh=3):
+def remove_rolling_outliers(df, window = '1h', columns='all', std_thresh=3, n_workers=1):
     """ Remove outliers from a dataframe using a rolling median and standard deviation.
     
     Args:
@@ -16,20 +16,38 @@ def remove_rolling_outliers(df, window = '1h', columns='all', std_thresh=3):
         window (str or int): Size of the rolling window. If a string, it should be a pandas offset alias (e.g. '1h', '1D'). If an integer, it should be the number of rows in the window.
         columns (list or str): Columns to remove outliers from. If 'all', all columns will be used.
         std_thresh (int): Number of standard deviations from the rolling median to consider as an outlier.
+        n_workers (int): Number of threads to split the columns across. pandas releases the GIL in its rolling kernels, so wide dataframes can use several cores. Defaults to 1.
     
     Returns:
         pd.DataFrame: Dataframe with outliers replaced with np.nan.
     """
 
-    out_df = df.copy(deep = True) #Make a copy of the dataframe to avoid modifying the original dataframe
-    if columns == 'all': #If all columns should be used
+    if isinstance(columns, str) and columns == 'all': #If all columns should be used
         columns = df.columns    
 
-    for col in columns: #Iterate over the columns
-        if not pd.api.types.is_numeric_dtype(out_df[col]):
-            continue
-        rolling_median = out_df[col].rolling(window=window, center=True,min_periods = 1).median() #Calculate the rolling median
-        rolling_std = out_df[col].rolling(window=window, center=True,min_periods=1).std() #Calculate the rolling standard deviation
-        outliers = (out_df[col] - rolling_median).abs() > std_thresh * rolling_std #Find the outliers
-        out_df.loc[outliers, col] = np.nan #Replace the outliers with np.nan
-    return out_df
+    numeric_cols = [col for col in columns if pd.api.types.is_numeric_dtype(df[col])] #Only numeric columns can have outliers
+    if not numeric_cols:
+        return df.copy()
+    if n_workers > 1 and len(numeric_cols) > 1: #Split the columns into groups and find the outliers of each group in its own thread
+        col_groups = [numeric_cols[i::n_workers] for i in range(min(n_workers, len(numeric_cols)))]
+        with ThreadPoolExecutor(max_workers=len(col_groups)) as executor:
+            outlier_dfs = list(executor.map(lambda cols: _rolling_outlier_mask(df[cols], window, std_thresh), col_groups))
+        outliers = pd.concat(outlier_dfs, axis=1)
+    else:
+        outliers = _rolling_outlier_mask(df[numeric_cols], window, std_thresh)
+    return df.mask(outliers.reindex(columns=df.columns, fill_value=False)) #Build the result in one pass, df itself is never modified
+
+def _rolling_outlier_mask(df, window, std_thresh):
+    """ Find values further than std_thresh rolling standard deviations from the rolling median.
+
+    Args:
+        df (pd.DataFrame): Numeric dataframe to check.
+        window (str or int): Size of the rolling window, as in remove_rolling_outliers.
+        std_thresh (int): Number of standard deviations from the rolling median to consider as an outlier.
+
+    Returns:
+        pd.DataFrame: Boolean dataframe, True where the value is an outlier.
+    """
+
+    rolling = df.rolling(window=window, center=True, min_periods=1) #One rolling window over all the columns at once
+    return (df - rolling.median()).abs() > std_thresh * rolling.std()
@@ -1,24 +1,26 @@
 #Import Packages
 import os
-import subprocess
+import re
 import shutil
-import glob
-import filecmp
-import numpy as np
-import pandas as pd
 import git
 
 ##################################################################################################################################
 # Define Functions
+_githash_cache = {} #git hash keyed on the working directory, the repo is searched from there
+
 def get_githash():
     '''Gets the git hash of the current code to save as metadata in regridded/changed objects
+
+    The hash is looked up once per process and working directory, since the code doesn't change under a running script
     
     Returns:
     githash (str) : the hash of the current git commit
     '''
-    repo = git.Repo(search_parent_directories=True)
-    sha = repo.head.object.hexsha
-    return sha
+    cwd = os.getcwd()
+    if cwd not in _githash_cache:
+        repo = git.Repo(search_parent_directories=True)
+        _githash_cache[cwd] = repo.head.object.hexsha
+    return _githash_cache[cwd]
 
 def check_space(path,excep_thresh='8Tb'):
     '''Checks the amount of space on a filesystem given a path, and raise an error if the amount of space is below the threshold
@@ -48,21 +50,26 @@ def check_space(path,excep_thresh='8Tb'):
         print(f'Found {bytes_to_human(free_bytes)} free space')
         return disk_usage
     
-def human_to_bytes(human_readable, units=['b', 'Kb', 'Mb', 'Gb', 'Tb', 'Pb']):
+_byte_units = ('b', 'Kb', 'Mb', 'Gb', 'Tb', 'Pb') #immutable, so the shared default argument can't be changed by a caller
+_human_size_re = re.compile(r'\s*([\d.]+)\s*(\S*)\s*$') #a number, then the unit (validated against the units list below)
+
+def human_to_bytes(human_readable, units=_byte_units):
     '''Makes a human readable storage size into a bytes integer
     #TODO Different definitions for this and the other direction (1000 bytes per kb vs 1024)
     
     Args:
     human_readable (str) : a human readable string representing space (something like 2.1Gb, or 5Tb)
-    units (list) : list of strings defining the units 
+    units (tuple) : strings defining the units, each 1024 times the last 
     
     Returns:
     bytes (int) : integer representing how many bytes the human readable string is
     '''
 
     # Split the input string into value and unit
-    value_str = ''.join([ch for ch in human_readable if ch.isdigit() or ch == '.'])
-    unit_str = ''.join([ch for ch in human_readable if not ch.isdigit() and ch != '.']).strip()
+    match = _human_size_re.match(human_readable)
+    if match is None:
+        raise ValueError(f"Could not parse '{human_readable}' as a number followed by a unit.")
+    value_str, unit_str = match.groups()
     value = float(value_str)# Convert value string to a float
     
     # Find the unit in the provided units list
@@ -75,36 +82,41 @@ def human_to_bytes(human_readable, units=['b', 'Kb', 'Mb', 'Gb', 'Tb', 'Pb']):
     bytes = int(value * multiplier)   # Convert the human-readable value to bytes    
     return bytes
 
-def bytes_to_human(bytes,units=['b','Kb','Mb','Gb','Tb','Pb']):
+def bytes_to_human(bytes,units=_byte_units):
     '''Converts an integer bytes into a human readable string notation
     #TODO Different definitions for this and the other direction (1000 bytes per kb vs 1024)
     
     Args: 
     bytes (int) : integer bytes
-    units (list) : unit convention for factors of 10 
+    units (tuple) : strings defining the units, each 1024 times the last 
     
     Returns (str) : the human readable string
     '''
 
-    return str(bytes) + units[0] if bytes < 1024 else bytes_to_human(bytes>>10, units[1:])
+    unit_index = min((bytes.bit_length() - 1) // 10, len(units) - 1) if bytes >= 1024 else 0 #each unit is 10 bits, clamped to the largest unit
+    return str(bytes >> (10 * unit_index)) + units[unit_index]
 
 def listdir_visible(path,add_path = False):
     '''Function to list only "visible" files/folders (not starting with a period)
     
     Args:
     path (str) : the filepath to list elements of
+    add_path (bool) : whether to return the full paths rather than just the names, defaults False
     
     Returns:
     vis_list (list) : list of files within the input path not starting with a period
     '''
     
-    vis_list = [f for f in os.listdir(path) if not f.startswith('.')]
-    if add_path:
-        vis_list = [os.path.join(path,f) for f in vis_list]
+    with os.scandir(path) as entries: #DirEntry already holds the joined path, so no os.path.join per entry
+        vis_list = [entry.path if add_path else entry.name for entry in entries if not entry.name.startswith('.')]
     return vis_list
 
+_credentials_cache = {} #parsed credentials keyed on (path, mtime) so a rewritten file is re-read
+
 def read_credentials(fullpath):
     """Read the credentials file and return the username and password
+
+    The parsed file is cached, so repeated calls only stat the file unless it has been modified.
     
     Args:
     fullpath (str) : full path to the credentials file
@@ -112,13 +124,12 @@ def read_credentials(fullpath):
     Returns:
     dict : dictionary with keys 'username' and 'password'
     """
-    credentials ={}
-    with open(fullpath) as f:
-        lines = f.readlines()
-        for line in lines:
-            key,value = line.strip().split('=')
-            credentials[key] = value
-    return credentials
+    cache_key = (os.path.abspath(fullpath), os.stat(fullpath).st_mtime)
+    if cache_key not in _credentials_cache:
+        with open(fullpath) as f:
+            lines = [line.strip() for line in f.read().splitlines()]
+        _credentials_cache[cache_key] = dict(line.split('=',1) for line in lines if '=' in line) #split on the first = only, so passwords can contain one
+    return dict(_credentials_cache[cache_key]) #copy so callers can't change the cached credentials
 
 
 def main():
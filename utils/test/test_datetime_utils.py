@@ -9,6 +9,13 @@ def test_DateTimeRange():
     assert dtr.__dict__ == {'tz': datetime.timezone.utc, 'start_dt': datetime.datetime(2021,1,1,0,0), 
                             'end_dt': datetime.datetime(2021,1,2,0,0)}
 
+def test_get_dates_in_range_dst():
+    spring = datetime_utils.DateTimeRange('2021-03-01 02:30','2021-03-20',tz='US/Mountain') #02:30 doesn't exist on 2021-03-14
+    assert spring.get_dates_in_range() == [datetime.date(2021,3,day) for day in range(1,20)]
+    fall = datetime_utils.DateTimeRange('2021-10-30 01:30','2021-11-10',tz='US/Mountain') #01:30 happens twice on 2021-11-07
+    assert fall.get_dates_in_range() == [datetime.date(2021,10,30),datetime.date(2021,10,31)] + [datetime.date(2021,11,day) for day in range(1,10)]
+    assert fall.get_dates_in_range(fmt='%Y%m%d')[-1] == '20211109'
+
 
 def main():
     dtr = datetime_utils.DateTimeRange(datetime.datetime(2021,1,1),datetime.datetime(2021,1,2))